@@ -1,13 +1,35 @@
+import bisect
 import json
 import math
 from datetime import datetime
+from functools import lru_cache
 from typing import Any
-from urllib import error, request
 
 import folium
+import numpy as np
+import requests
 import streamlit as st
 from streamlit_folium import st_folium
 
+try:
+    # orjsonはbytesを直接受け、stdlib jsonの数倍速い（任意依存）
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    from numba import njit
+
+    _NUMBA_AVAILABLE = True
+except ImportError:  # numbaは任意依存。無ければ純Pythonで動かす
+    _NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):  # noqa: ARG001
+        def wrap(fn):
+            return fn
+
+        return wrap
+
 
 st.set_page_config(page_title="レッドスプライト観測予測(Web)", layout="wide")
 
@@ -20,14 +42,191 @@ def clamp(value: float, min_value: float = 0.0, max_value: float = 1.0) -> float
     return value
 
 
-def trapezoid_score(value: float, low: float, opt_low: float, opt_high: float, high: float) -> float:
-    if value <= low or value >= high:
-        return 0.0
-    if opt_low <= value <= opt_high:
-        return 1.0
-    if value < opt_low:
-        return clamp((value - low) / (opt_low - low))
-    return clamp((high - value) / (high - opt_high))
+# 21-02時=1.0, 18-20/3-5時=0.6, それ以外=0.1 (時刻で直接引く)
+# クラス: 0=夜間, 1=薄暮/明け方, 2=日中
+_HOUR_CLASS = tuple(0 if h in (21, 22, 23, 0, 1, 2) else 1 if h in (18, 19, 20, 3, 4, 5) else 2 for h in range(24))
+_HOUR_SCORES = tuple((1.0, 0.6, 0.1)[c] for c in _HOUR_CLASS)
+_HOUR_REASONS = (
+    "夜間（21-02時）で観測しやすい。",
+    "薄暮/明け方で観測可能性は中程度。",
+    "日中帯で観測困難。",
+)
+_HOUR_LUT = np.array(_HOUR_SCORES)
+
+# ロジスティック回帰の重み。列順: 緯度, 季節, 時刻, 雷活動, 視程, 雲, 月
+_W = np.array([0.6, 0.5, 0.4, 2.0, 0.6, 0.4, 0.2])
+_BIAS = -3.0
+
+
+def _score_matrix(scores: np.ndarray) -> np.ndarray:
+    """(..., 7)のスコア行列からzを一括計算する。列順は_Wと同じ。"""
+    return _BIAS + scores @ _W
+
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    """数値安定な分岐なしシグモイド。σ(z) = (1 + tanh(z/2)) / 2 はexp形と等価で飽和しても安全。"""
+    return 0.5 * (1.0 + np.tanh(0.5 * z))
+
+
+def trapezoid_score(value, low: float, opt_low: float, opt_high: float, high: float):
+    """台形スコア。スカラーでも配列でも0〜1を返す。
+
+    立ち上がり/立ち下がり直線のminを[0,1]に切り詰めると台形になるので、
+    分岐なしの4演算+min/clipで済む（SIMD化にも都合が良い）。
+    """
+    v = np.asarray(value, dtype=np.float64)
+    rise = (v - low) / (opt_low - low)
+    fall = (high - v) / (high - opt_high)
+    return np.clip(np.minimum(rise, fall), 0.0, 1.0)
+
+
+def _lat_score(v):
+    # trapezoid_score(v, -10, 10, 45, 60) の定数畳み込み版（逆数乗算）
+    v = np.asarray(v, dtype=np.float64)
+    return np.clip(np.minimum((v + 10.0) * 0.05, (60.0 - v) * (1.0 / 15.0)), 0.0, 1.0)
+
+
+def _month_score(v):
+    # trapezoid_score(v, 2.5, 5.0, 9.0, 11.5) の定数畳み込み版（逆数乗算）
+    v = np.asarray(v, dtype=np.float64)
+    return np.clip(np.minimum((v - 2.5) * 0.4, (11.5 - v) * 0.4), 0.0, 1.0)
+
+
+@njit("float64(float64,float64,float64,float64,float64)")
+def _trapezoid_core(v: float, low: float, opt_low: float, opt_high: float, high: float) -> float:
+    rise = (v - low) / (opt_low - low)
+    fall = (high - v) / (high - opt_high)
+    return max(0.0, min(1.0, rise, fall))
+
+
+# シグネチャを固定してimport時にコンパイル（初回クリックの遅延を避ける）
+# 戻り値: (確率, 緯度, 季節, 時刻, 雷活動, 雲, 月, 視程)の各スコア
+# fastmathは付けない: 除算→逆数乗算の書き換えで丸めが1ulpずれ、
+# 理由文のしきい値判定とベクトル版との一致が壊れる
+# cache=Trueも付けない: このスクリプトをモジュールとしてimportすると
+# numbaがモジュール名"main"でキャッシュし、次のアプリ起動時のキャッシュ
+# 復元で再importが走ってst.set_page_configが二重呼び出しになる
+@njit("UniTuple(float64, 8)(float64,int64,int64,float64,float64,float64,float64)")
+def _predict_core(
+    lat: float, month: int, hour: int, storm: float, cloud: float, moon: float, vis: float
+) -> tuple[float, ...]:
+    lat_score = _trapezoid_core(lat, -10.0, 10.0, 45.0, 60.0)
+    month_score = _trapezoid_core(month * 1.0, 2.5, 5.0, 9.0, 11.5)
+    hour_score = _HOUR_LUT[hour]
+    # 入力はウィジェット側で 0-10 / 0-100 / 0-40 に制限済みなのでクランプ不要。
+    # 除算のままにする: 逆数乗算(*0.1等)は丸めが1ulpずれ、理由文の厳密な
+    # しきい値(>0.7など)の判定やベクトル版との一致が壊れる
+    storm_factor = storm / 10.0
+    cloud_clear = 1.0 - cloud / 100.0
+    moon_dark = 1.0 - moon / 100.0
+    visibility_factor = vis / 40.0
+    z = (
+        -3.0
+        + 0.6 * lat_score
+        + 0.5 * month_score
+        + 0.4 * hour_score
+        + 2.0 * storm_factor
+        + 0.6 * visibility_factor
+        + 0.4 * cloud_clear
+        + 0.2 * moon_dark
+    )
+    # 分岐なしの安定シグモイド: σ(z) = (1 + tanh(z/2)) / 2（tanhは飽和してもオーバーフローしない）
+    probability = 0.5 * (1.0 + math.tanh(0.5 * z))
+    return probability, lat_score, month_score, hour_score, storm_factor, cloud_clear, moon_dark, visibility_factor
+
+
+def _score_vec(lat, month, hour, storm, cloud, moon, vis) -> tuple[np.ndarray, np.ndarray]:
+    """配列入力の出現確率と(...,7)スコア行列をまとめて計算する（地図オーバーレイ等の一括評価用）。
+
+    スコア行列の列順は_Wと同じ（緯度, 季節, 時刻, 雷活動, 視程, 雲, 月）。
+    """
+    lat_score = _lat_score(lat)
+    month_score = _month_score(month)
+    hour_score = _HOUR_LUT[np.asarray(hour, dtype=np.intp)]
+    storm_factor = np.clip(np.asarray(storm, dtype=np.float64) / 10.0, 0.0, 1.0)
+    cloud_clear = np.clip(1.0 - np.asarray(cloud, dtype=np.float64) / 100.0, 0.0, 1.0)
+    moon_dark = np.clip(1.0 - np.asarray(moon, dtype=np.float64) / 100.0, 0.0, 1.0)
+    visibility_factor = np.clip(np.asarray(vis, dtype=np.float64) / 40.0, 0.0, 1.0)
+
+    scores = np.stack(
+        np.broadcast_arrays(
+            lat_score, month_score, hour_score, storm_factor, visibility_factor, cloud_clear, moon_dark
+        ),
+        axis=-1,
+    )
+    z = _score_matrix(scores)
+    return _sigmoid(z), scores
+
+
+def _gt(t: float) -> float:
+    # 「score > t」を「score >= しきい値」の一様なテーブルで表すための次の浮動小数点数
+    return math.nextafter(t, math.inf)
+
+
+# 各スコアの理由文バンド。score >= しきい値 を満たす最初の文を採用する
+# 行順は _reasons_for の引数順（緯度, 季節, 雷活動, 雲, 月, 視程）
+_REASON_TABLE: tuple[tuple[tuple[float, str], ...], ...] = (
+    (
+        (0.9, "緯度は最適帯（10-45度）で有利。"),
+        (0.5, "緯度は許容帯（〜60度）でやや有利。"),
+        (-math.inf, "緯度が典型帯から外れ、寄与が低い。"),
+    ),
+    (
+        (0.9, "季節は暖候期（5-9月）で対流活動が強まりやすい。"),
+        (0.4, "季節は肩シーズンで中程度の寄与。"),
+        (-math.inf, "寒候期で季節寄与が弱い。"),
+    ),
+    (
+        (_gt(0.7), "雷活動が非常に活発。"),
+        (_gt(0.4), "雷活動は中程度。"),
+        (-math.inf, "雷活動が弱く誘発しづらい。"),
+    ),
+    (
+        (_gt(0.6), "雲が少なく視程を阻害しない。"),
+        (_gt(0.3), "雲がやや多めで減衰あり。"),
+        (-math.inf, "雲が多く上空が遮られている。"),
+    ),
+    (
+        (_gt(0.7), "月明かりが弱く空が暗い。"),
+        (_gt(0.3), "月明かりは中程度。"),
+        (-math.inf, "月明かりが強く暗順応しづらい。"),
+    ),
+    (
+        (0.5, "視程良好。"),
+        (-math.inf, "視程が短く減光が大きい。"),
+    ),
+)
+
+
+def score_grid(lat_arr, lon_arr, month: int, hour: int, storm: float, cloud: float, moon: float, vis: float) -> np.ndarray:
+    """地図オーバーレイ用に格子点の出現確率をまとめて採点する。
+
+    lat_arr/lon_arrは任意形状（通常は2D格子）で、その他の条件はスカラーとして
+    全点にブロードキャストされる。戻り値は格子と同形状のfloat32配列。
+    経度は現行モデルでは確率に寄与しないが、将来の項追加に備えて受け取る。
+    """
+    lat = np.asarray(lat_arr, dtype=np.float64)
+    lon = np.asarray(lon_arr, dtype=np.float64)
+    shape = np.broadcast_shapes(lat.shape, lon.shape)
+    probs, _ = _score_vec(np.broadcast_to(lat, shape), month, hour, storm, cloud, moon, vis)
+    return probs.astype(np.float32)
+
+
+def _reasons_for(
+    hour: int,
+    lat_score: float,
+    month_score: float,
+    storm_factor: float,
+    cloud_clear: float,
+    moon_dark: float,
+    visibility_factor: float,
+) -> list[str]:
+    """単一地点のGUI表示用に、各スコアを日本語の理由文へ変換する。"""
+    scores = (lat_score, month_score, storm_factor, cloud_clear, moon_dark, visibility_factor)
+    reasons = [next(msg for t, msg in bands if score >= t) for bands, score in zip(_REASON_TABLE, scores)]
+    # 時刻の理由は表示順で3番目（緯度・季節の次）
+    reasons.insert(2, _HOUR_REASONS[_HOUR_CLASS[hour]])
+    return reasons
 
 
 def predict_red_sprite_probability(
@@ -39,80 +238,21 @@ def predict_red_sprite_probability(
     cloud_cover: float,
     moon_brightness: float,
     visibility_km: float,
+    with_reasons: bool = True,
 ) -> tuple[float, list[str], str]:
-    reasons: list[str] = []
-
-    lat_score = trapezoid_score(latitude, low=-10.0, opt_low=10.0, opt_high=45.0, high=60.0)
-    month_score = trapezoid_score(month, low=2.5, opt_low=5.0, opt_high=9.0, high=11.5)
-    if 21 <= hour <= 23 or 0 <= hour <= 2:
-        hour_score = 1.0
-    elif 18 <= hour <= 20 or 3 <= hour <= 5:
-        hour_score = 0.6
-    else:
-        hour_score = 0.1
-    storm_factor = clamp(storm_activity / 10.0)
-    cloud_clear = clamp(1.0 - (cloud_cover / 100.0))
-    moon_dark = clamp(1.0 - (moon_brightness / 100.0))
-    visibility_factor = clamp(visibility_km / 40.0)
-
-    z = (
-        -3.0
-        + 0.6 * lat_score
-        + 0.5 * month_score
-        + 0.4 * hour_score
-        + 2.0 * storm_factor
-        + 0.6 * visibility_factor
-        + 0.4 * cloud_clear
-        + 0.2 * moon_dark
+    probability, lat_score, month_score, _hour_score, storm_factor, cloud_clear, moon_dark, visibility_factor = (
+        _predict_core(
+            float(latitude), int(month), int(hour),
+            float(storm_activity), float(cloud_cover), float(moon_brightness), float(visibility_km),
+        )
     )
-    probability = 1.0 / (1.0 + math.exp(-z))
-
-    if lat_score >= 0.9:
-        reasons.append("緯度は最適帯（10-45度）で有利。")
-    elif lat_score >= 0.5:
-        reasons.append("緯度は許容帯（〜60度）でやや有利。")
-    else:
-        reasons.append("緯度が典型帯から外れ、寄与が低い。")
+    if not with_reasons:
+        # 一括評価など確率だけ欲しい呼び出しでは文字列組み立てを丸ごと飛ばす
+        return probability, [], ""
 
-    if month_score >= 0.9:
-        reasons.append("季節は暖候期（5-9月）で対流活動が強まりやすい。")
-    elif month_score >= 0.4:
-        reasons.append("季節は肩シーズンで中程度の寄与。")
-    else:
-        reasons.append("寒候期で季節寄与が弱い。")
-
-    if hour_score == 1.0:
-        reasons.append("夜間（21-02時）で観測しやすい。")
-    elif hour_score == 0.6:
-        reasons.append("薄暮/明け方で観測可能性は中程度。")
-    else:
-        reasons.append("日中帯で観測困難。")
-
-    if storm_factor > 0.7:
-        reasons.append("雷活動が非常に活発。")
-    elif storm_factor > 0.4:
-        reasons.append("雷活動は中程度。")
-    else:
-        reasons.append("雷活動が弱く誘発しづらい。")
-
-    if cloud_clear > 0.6:
-        reasons.append("雲が少なく視程を阻害しない。")
-    elif cloud_clear > 0.3:
-        reasons.append("雲がやや多めで減衰あり。")
-    else:
-        reasons.append("雲が多く上空が遮られている。")
-
-    if moon_dark > 0.7:
-        reasons.append("月明かりが弱く空が暗い。")
-    elif moon_dark > 0.3:
-        reasons.append("月明かりは中程度。")
-    else:
-        reasons.append("月明かりが強く暗順応しづらい。")
-
-    if visibility_factor >= 0.5:
-        reasons.append("視程良好。")
-    else:
-        reasons.append("視程が短く減光が大きい。")
+    reasons = _reasons_for(
+        hour, lat_score, month_score, storm_factor, cloud_clear, moon_dark, visibility_factor
+    )
 
     if probability > 0.7:
         hint = "観測条件は良好。雷雲の真上より少し離れた方向を注視し、カメラと双眼鏡を準備。"
@@ -124,56 +264,121 @@ def predict_red_sprite_probability(
     return probability, reasons, hint
 
 
-def moon_illumination(dt: datetime) -> float:
-    year = dt.year
-    month = dt.month
-    day = dt.day + (dt.hour / 24.0)
+_AU_KM = 149597870.7
+
+
+def _moon_illum_days(d: float) -> float:
+    """J2000からの経過日数dに対する月の輝面比（Meeus第48章の位相角法の低次版）。
+
+    太陽と月の黄経・距離から離角ψ、位相角iを求め k=(1+cos i)/2 とする。
+    旧実装の朔望月ノコギリ波近似より位相ズレが小さい。
+    """
+    # 太陽（平均黄経・平均近点角→黄経、距離[AU]）
+    g = math.radians((357.529 + 0.98560028 * d) % 360.0)
+    q = 280.459 + 0.98564736 * d
+    lam_s = math.radians((q + 1.915 * math.sin(g) + 0.020 * math.sin(2.0 * g)) % 360.0)
+    r_s = 1.00014 - 0.01671 * math.cos(g) - 0.00014 * math.cos(2.0 * g)
+    # 月（Meeus低次項: 平均黄経L', 平均近点角M', 昇交点引数F）
+    lp = math.radians((218.316 + 13.176396 * d) % 360.0)
+    mp = math.radians((134.963 + 13.064993 * d) % 360.0)
+    f = math.radians((93.272 + 13.229350 * d) % 360.0)
+    lam_m = lp + math.radians(6.289) * math.sin(mp)
+    beta = math.radians(5.128) * math.sin(f)
+    r_m = (385001.0 - 20905.0 * math.cos(mp)) / _AU_KM
+    # 離角→位相角→輝面比
+    psi = math.acos(clamp(math.cos(beta) * math.cos(lam_m - lam_s), -1.0, 1.0))
+    i = math.atan2(r_s * math.sin(psi), r_m - r_s * math.cos(psi))
+    return clamp((1.0 + math.cos(i)) / 2.0)
+
+
+@lru_cache(maxsize=128)
+def _moon_illum_key(year: int, month: int, day_i: int, hour: int) -> float:
+    day = day_i + (hour / 24.0)
     if month < 3:
         year -= 1
         month += 12
     a = year // 100
     b = 2 - a + (a // 4)
     jd = int(365.25 * (year + 4716)) + int(30.6001 * (month + 1)) + day + b - 1524.5
-    days_since_new = jd - 2451549.5
-    synodic_month = 29.53058867
-    phase = (days_since_new % synodic_month) / synodic_month
-    illumination = (1 - math.cos(2 * math.pi * phase)) / 2
-    return clamp(illumination, 0.0, 1.0)
+    return _moon_illum_days(jd - 2451545.0)
 
 
-def fetch_weather(lat: float, lon: float, target_dt: datetime) -> tuple[float, float]:
+def moon_illumination(dt: datetime) -> float:
+    # (年,月,日,時)で決定的なので、その組をキーにメモ化
+    return _moon_illum_key(dt.year, dt.month, dt.day, dt.hour)
+
+
+def moon_illumination_array(dts) -> np.ndarray:
+    """datetime64配列の月明かりをまとめて推定する（数日分の推移表示などの一括評価用）。
+
+    スカラー版と同じMeeus位相角法をNumPyで一括計算する。
+    J2000(2000-01-01 12:00)からの経過日数を基準にとる。
+    """
+    d = (np.asarray(dts, dtype="datetime64[h]") - np.datetime64("2000-01-01T12", "h")).astype(np.float64) / 24.0
+    g = np.radians(np.mod(357.529 + 0.98560028 * d, 360.0))
+    q = 280.459 + 0.98564736 * d
+    lam_s = np.radians(np.mod(q + 1.915 * np.sin(g) + 0.020 * np.sin(2.0 * g), 360.0))
+    r_s = 1.00014 - 0.01671 * np.cos(g) - 0.00014 * np.cos(2.0 * g)
+    lp = np.radians(np.mod(218.316 + 13.176396 * d, 360.0))
+    mp = np.radians(np.mod(134.963 + 13.064993 * d, 360.0))
+    f = np.radians(np.mod(93.272 + 13.229350 * d, 360.0))
+    lam_m = lp + np.radians(6.289) * np.sin(mp)
+    beta = np.radians(5.128) * np.sin(f)
+    r_m = (385001.0 - 20905.0 * np.cos(mp)) / _AU_KM
+    psi = np.arccos(np.clip(np.cos(beta) * np.cos(lam_m - lam_s), -1.0, 1.0))
+    i = np.arctan2(r_s * np.sin(psi), r_m - r_s * np.cos(psi))
+    return np.clip((1.0 + np.cos(i)) / 2.0, 0.0, 1.0)
+
+
+@st.cache_resource(show_spinner=False)
+def _http() -> requests.Session:
+    # keep-aliveでTLSハンドシェイクを使い回す（クリックごとの再接続を避ける）
+    s = requests.Session()
+    s.headers.update({"Accept-Encoding": "gzip"})
+    return s
+
+
+@st.cache_data(ttl=900, show_spinner=False)
+def _fetch_weather_raw(lat_q: float, lon_q: float, hour_key: str) -> dict[str, Any]:
     url = (
         "https://api.open-meteo.com/v1/forecast"
-        f"?latitude={lat}&longitude={lon}"
+        f"?latitude={lat_q}&longitude={lon_q}"
         "&hourly=cloudcover,visibility"
-        "&past_days=1&forecast_days=1&timezone=auto"
+        f"&start_hour={hour_key}:00&end_hour={hour_key}:00&timezone=auto"
     )
     try:
-        with request.urlopen(url, timeout=10) as resp:
-            data = json.loads(resp.read().decode("utf-8"))
-    except error.URLError as exc:
+        with _http().get(url, timeout=10, stream=True) as resp:
+            resp.raise_for_status()
+            # 想定外に巨大なレスポンスでメモリを食わないよう読み取り量を制限
+            data = _json_loads(resp.raw.read(1_000_000, decode_content=True))
+    except requests.RequestException as exc:
         raise RuntimeError(f"通信エラー: {exc}") from exc
-    except json.JSONDecodeError as exc:
+    except ValueError as exc:  # json/orjsonどちらのJSONDecodeErrorもValueError派生
         raise RuntimeError("レスポンスの解析に失敗しました") from exc
 
     hourly = data.get("hourly")
     if not hourly or "time" not in hourly:
         raise RuntimeError("時間別データが見つかりませんでした")
+    return hourly
 
-    times = hourly["time"]
+
+def fetch_weather(lat: float, lon: float, target_dt: datetime) -> tuple[float, float]:
+    # 同一地点・同一時刻の再取得は15分間キャッシュから返す
+    # 対象1時間分だけ要求しているため、通常は先頭サンプルがそのまま答え
+    hourly = _fetch_weather_raw(round(lat, 2), round(lon, 2), target_dt.strftime("%Y-%m-%dT%H"))
+    times = hourly.get("time", [])
     clouds = hourly.get("cloudcover", [])
     visibilities = hourly.get("visibility", [])
-    target_key = target_dt.strftime("%Y-%m-%dT%H:00")
 
-    def nearest_index() -> int:
-        for idx, t in enumerate(times):
-            if t.startswith(target_key):
-                return idx
-        target_no_tz = datetime.strptime(target_key, "%Y-%m-%dT%H:00")
-        deltas = [abs(datetime.fromisoformat(t) - target_no_tz) for t in times]
-        return deltas.index(min(deltas))
+    idx = 0
+    if len(times) > 1:
+        # APIが複数サンプルを返した場合の保険。固定幅ISO文字列は辞書順=時刻順なので
+        # 二分探索で挟み、前後2件だけ実際にパースして近い方を選ぶ
+        i = bisect.bisect_left(times, target_dt.strftime("%Y-%m-%dT%H:00"))
+        target_nv = target_dt.replace(tzinfo=None)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(times)]
+        idx = min(candidates, key=lambda j: abs(datetime.fromisoformat(times[j]) - target_nv))
 
-    idx = nearest_index()
     try:
         cloud_val = float(clouds[idx])
         vis_val_km = float(visibilities[idx]) / 1000.0
@@ -183,18 +388,21 @@ def fetch_weather(lat: float, lon: float, target_dt: datetime) -> tuple[float, f
 
 
 def init_state() -> None:
-    defaults = {
-        "lat": 35.0,
-        "lon": 138.0,
-        "month": datetime.now().month,
-        "hour": datetime.now().hour,
-        "storm": 6.0,
-        "cloud": 30.0,
-        "moon": 40.0,
-        "vis": 20.0,
-    }
-    for k, v in defaults.items():
-        st.session_state.setdefault(k, v)
+    if "lat" in st.session_state:
+        return
+    now = datetime.now()
+    st.session_state.update(
+        {
+            "lat": 35.0,
+            "lon": 138.0,
+            "month": now.month,
+            "hour": now.hour,
+            "storm": 6.0,
+            "cloud": 30.0,
+            "moon": 40.0,
+            "vis": 20.0,
+        }
+    )
 
 
 def state_float(key: str, default: float, min_v: float | None = None, max_v: float | None = None) -> float:
@@ -223,13 +431,57 @@ def state_int(key: str, default: int, min_v: int | None = None, max_v: int | Non
     return val
 
 
+# max_entriesで上限を設ける: 座標ごとにエントリが増えるため、無制限だと
+# 地図クリックのたびにMapオブジェクトがプロセス全体に溜まり続ける
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _make_folium_map(lat_q: float, lon_q: float) -> folium.Map:
+    m = folium.Map(location=[lat_q, lon_q], zoom_start=5, control_scale=True)
+    folium.Marker([lat_q, lon_q], tooltip=f"{lat_q:.3f}, {lon_q:.3f}").add_to(m)
+    return m
+
+
 def build_map(lat: float, lon: float) -> dict[str, Any] | None:
-    m = folium.Map(location=[lat, lon], zoom_start=5, control_scale=True)
-    folium.Marker([lat, lon], tooltip=f"{lat:.3f}, {lon:.3f}").add_to(m)
+    # スライダー操作の再実行では地図を作り直さない（座標が変わった時だけ再構築）
+    m = _make_folium_map(round(lat, 3), round(lon, 3))
     return st_folium(m, width=520, height=480, key="map")
 
 
-def render_inputs() -> None:
+# 入力目安のヘルプ文。再実行のたびに組み立て直さないようモジュール定数にする
+_STORM_HELP = (
+    "- 雷ナウキャスト: 色付き発雷域が連続=6〜8, 広域で強=9〜10, 点在=3〜5, 無=0\n"
+    "- 落雷回数(直近1h): 0=0, 1-3=2〜3, 4-10=5, 11-30=8, 30+ =9〜10\n"
+    "- レーダー強エコー: 35-45dBZ孤立=2〜5, 45-55dBZ群=6〜8, 55dBZ超=9〜10\n"
+    "- 雷検知器10分平均: 0=0, 1-2=3, 3-5=5, 6-10=7, 10+ =9〜10\n"
+    "- 体感: 遠雷たまに=3〜4, 10分に数回=5〜6, ほぼ鳴り続く=8〜10"
+)
+_CLOUD_HELP = (
+    "- 衛星画像: 厚い雲=80〜100, 積雲帯/まとまり=40〜70, ほぼ雲なし=0〜20\n"
+    "- オクタ換算: 0/8=0,1/8=12,2/8=25,3/8=37,4/8=50,5/8=62,6/8=75,7/8=87,8/8=100\n"
+    "- 目視: 空の雲が7〜10割=70〜100, 4〜6割=40〜60, 1〜3割=10〜30, 快晴=0〜5\n"
+    "- 星の見え方: うっすら見える=20〜40, ほぼ見えない=60〜90"
+)
+_MOON_HELP = (
+    "- 月齢: 新月〜三日月=0〜20, 上弦/下弦=40〜60, 十三夜〜満月=80〜100\n"
+    "- 月高度: 低い=20〜40%, 高いほど+20〜40%\n"
+    "- 雲越し: 朧月=20〜40, 厚めの雲でボヤける=40〜70, くっきり=70〜100\n"
+    "- 体感: 見えない=0〜10, ぼんやり=30〜50, 眩しく影=70〜100"
+)
+_VIS_HELP = (
+    "- METAR VIS: 10km+ →10〜15km、9999なら15km以上\n"
+    "- 地物: 山/ランドマークの距離で 5/10/20km など\n"
+    "- 星空: 天の川くっきり=15〜25km, ぼんやり=8〜15km, 見えない=〜5km\n"
+    "- 霧/黄砂: 輪郭不明=2〜5km, 形が崩れる=1〜2km, 直近のみ=0〜1km"
+)
+
+
+def _queue_auto_fetch() -> None:
+    # form_submit_buttonのon_click用。コールバックは再実行の先頭
+    # （フォーム値の同期後・スクリプト実行前）に走るので、
+    # main()冒頭でフラグを見れば同一実行内で自動取得できる
+    st.session_state["fetch_requested"] = True
+
+
+def render_inputs() -> bool:
     st.subheader("観測条件の入力")
     # セッション値を安全に数値へ正規化
     lat_val = state_float("lat", 35.0, -90.0, 90.0)
@@ -241,46 +493,36 @@ def render_inputs() -> None:
     moon_val = state_float("moon", 40.0, 0.0, 100.0)
     vis_val = state_float("vis", 20.0, 0.0, 40.0)
 
-    col1, col2 = st.columns([1, 1])
-    with col1:
-        st.number_input("緯度 (-90〜90)", value=lat_val, key="lat", step=0.1)
-        st.number_input("経度 (-180〜180)", value=lon_val, key="lon", step=0.1)
-        st.number_input("月 (1-12)", min_value=1, max_value=12, value=month_val, key="month")
-        st.number_input("時刻 (0-23)", min_value=0, max_value=23, value=hour_val, key="hour")
-        st.slider("雷活動（0:静穏〜10:非常に活発）", 0.0, 10.0, value=storm_val, step=0.5, key="storm")
-        with st.expander("雷活動の目安"):
-            st.write(
-                "- 雷ナウキャスト: 色付き発雷域が連続=6〜8, 広域で強=9〜10, 点在=3〜5, 無=0\n"
-                "- 落雷回数(直近1h): 0=0, 1-3=2〜3, 4-10=5, 11-30=8, 30+ =9〜10\n"
-                "- レーダー強エコー: 35-45dBZ孤立=2〜5, 45-55dBZ群=6〜8, 55dBZ超=9〜10\n"
-                "- 雷検知器10分平均: 0=0, 1-2=3, 3-5=5, 6-10=7, 10+ =9〜10\n"
-                "- 体感: 遠雷たまに=3〜4, 10分に数回=5〜6, ほぼ鳴り続く=8〜10"
-            )
-    with col2:
-        st.slider("雲量％", 0.0, 100.0, value=cloud_val, step=5.0, key="cloud")
-        with st.expander("雲量の目安"):
-            st.write(
-                "- 衛星画像: 厚い雲=80〜100, 積雲帯/まとまり=40〜70, ほぼ雲なし=0〜20\n"
-                "- オクタ換算: 0/8=0,1/8=12,2/8=25,3/8=37,4/8=50,5/8=62,6/8=75,7/8=87,8/8=100\n"
-                "- 目視: 空の雲が7〜10割=70〜100, 4〜6割=40〜60, 1〜3割=10〜30, 快晴=0〜5\n"
-                "- 星の見え方: うっすら見える=20〜40, ほぼ見えない=60〜90"
-            )
-        st.slider("月明かりの明るさ％", 0.0, 100.0, value=moon_val, step=5.0, key="moon")
-        with st.expander("月明かりの目安"):
-            st.write(
-                "- 月齢: 新月〜三日月=0〜20, 上弦/下弦=40〜60, 十三夜〜満月=80〜100\n"
-                "- 月高度: 低い=20〜40%, 高いほど+20〜40%\n"
-                "- 雲越し: 朧月=20〜40, 厚めの雲でボヤける=40〜70, くっきり=70〜100\n"
-                "- 体感: 見えない=0〜10, ぼんやり=30〜50, 眩しく影=70〜100"
-            )
-        st.slider("視程 (km) 0-40", 0.0, 40.0, value=vis_val, step=1.0, key="vis")
-        with st.expander("視程の目安"):
-            st.write(
-                "- METAR VIS: 10km+ →10〜15km、9999なら15km以上\n"
-                "- 地物: 山/ランドマークの距離で 5/10/20km など\n"
-                "- 星空: 天の川くっきり=15〜25km, ぼんやり=8〜15km, 見えない=〜5km\n"
-                "- 霧/黄砂: 輪郭不明=2〜5km, 形が崩れる=1〜2km, 直近のみ=0〜1km"
+    with st.form("obs_inputs", clear_on_submit=False):
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            st.number_input("緯度 (-90〜90)", value=lat_val, key="lat", step=0.1)
+            st.number_input("経度 (-180〜180)", value=lon_val, key="lon", step=0.1)
+            st.number_input("月 (1-12)", min_value=1, max_value=12, value=month_val, key="month")
+            st.number_input("時刻 (0-23)", min_value=0, max_value=23, value=hour_val, key="hour")
+            st.slider("雷活動（0:静穏〜10:非常に活発）", 0.0, 10.0, value=storm_val, step=0.5, key="storm")
+            with st.expander("雷活動の目安"):
+                st.write(_STORM_HELP)
+        with col2:
+            st.slider("雲量％", 0.0, 100.0, value=cloud_val, step=5.0, key="cloud")
+            with st.expander("雲量の目安"):
+                st.write(_CLOUD_HELP)
+            st.slider("月明かりの明るさ％", 0.0, 100.0, value=moon_val, step=5.0, key="moon")
+            with st.expander("月明かりの目安"):
+                st.write(_MOON_HELP)
+            st.slider("視程 (km) 0-40", 0.0, 40.0, value=vis_val, step=1.0, key="vis")
+            with st.expander("視程の目安"):
+                st.write(_VIS_HELP)
+        col_submit, col_fetch = st.columns([1, 1])
+        with col_submit:
+            submitted = st.form_submit_button("予測する", type="primary")
+        with col_fetch:
+            # 2つ目の送信ボタン。フォーム送信として扱われるため、
+            # 編集中のlat/lon/hourが同期されてから自動取得が走る
+            st.form_submit_button(
+                "APIで自動取得（雲量・視程・月明かり）", on_click=_queue_auto_fetch
             )
+    return submitted
 
 
 def render_map() -> None:
@@ -294,42 +536,46 @@ def render_map() -> None:
 
 
 def render_actions() -> None:
-    col1, col2, col3 = st.columns([1, 1, 1])
-    with col1:
-        if st.button("予測する", type="primary"):
-            run_prediction_and_show()
-    with col2:
-        if st.button("APIで自動取得（雲量・視程・月明かり）"):
-            auto_fetch()
-    with col3:
-        if st.button("理想条件を見る"):
-            show_best_conditions()
+    # 「予測する」「APIで自動取得」はフォームの送信ボタンに移動
+    # （入力変更のたびの再実行を1回に集約しつつ、編集途中の値も送信時に同期される）
+    if st.button("理想条件を見る"):
+        show_best_conditions()
 
 
 def run_prediction_and_show() -> None:
+    # render_inputs冒頭のstate_float/state_intで型・範囲は正規化済みなので再変換しない
+    s = st.session_state
     try:
         prob, reasons, hint = predict_red_sprite_probability(
-            latitude=float(st.session_state["lat"]),
-            longitude=float(st.session_state["lon"]),
-            month=int(st.session_state["month"]),
-            hour=int(st.session_state["hour"]),
-            storm_activity=float(st.session_state["storm"]),
-            cloud_cover=float(st.session_state["cloud"]),
-            moon_brightness=float(st.session_state["moon"]),
-            visibility_km=float(st.session_state["vis"]),
+            latitude=s["lat"],
+            longitude=s["lon"],
+            month=s["month"],
+            hour=s["hour"],
+            storm_activity=s["storm"],
+            cloud_cover=s["cloud"],
+            moon_brightness=s["moon"],
+            visibility_km=s["vis"],
         )
     except Exception as exc:  # noqa: BLE001
         st.error(f"計算に失敗しました: {exc}")
         return
 
+    # 結果はセッションに保持し、以後の再実行では再計算せずそのまま描画する
+    st.session_state["last_result"] = (prob, reasons, hint)
+
+
+def render_result() -> None:
+    result = st.session_state.get("last_result")
+    if result is None:
+        return
+    prob, reasons, hint = result
     percent = round(prob * 100)
     st.subheader("予測結果")
     st.progress(prob, text=f"{percent}%")
     st.metric("出現確率 (推定)", f"{percent} %")
     st.write(f"**観測ヒント:** {hint}")
-    st.write("**理由**")
-    for r in reasons:
-        st.write(f"- {r}")
+    # 1行ずつst.writeせず、1つのmarkdown要素にまとめて描画コストを抑える
+    st.markdown("**理由**\n" + "\n".join(f"- {r}" for r in reasons))
 
 
 def auto_fetch() -> None:
@@ -343,7 +589,9 @@ def auto_fetch() -> None:
 
     target_dt = datetime.now().replace(minute=0, second=0, microsecond=0, hour=hour)
     try:
-        cloud, visibility = fetch_weather(lat, lon, target_dt)
+        # 取得中（最大10秒）も画面が固まって見えないようスピナーを出す
+        with st.spinner("気象データ取得中…"):
+            cloud, visibility = fetch_weather(lat, lon, target_dt)
     except Exception as exc:  # noqa: BLE001
         st.error(f"天気APIの取得に失敗しました: {exc}")
         return
@@ -355,56 +603,64 @@ def auto_fetch() -> None:
     st.success(
         f"自動取得完了: 雲量 {cloud:.1f}%, 視程 {visibility:.1f} km, 月明かり推定 {moon_pct}%"
     )
-    # Streamlitのバージョンに応じて再実行APIが異なる
-    if hasattr(st, "rerun"):
-        st.rerun()
-    else:
-        st.experimental_rerun()
+    # アクションは入力ウィジェットより先に処理されるため、この実行内で
+    # 更新後のsession_stateがそのまま描画に反映される。明示的な再実行は不要
+
+
+_BEST_CONDITIONS_MD = (
+    "理想に近い観測条件の目安:\n"
+    "- 場所: 緯度10〜45度帯。都市光害が少ない開けた場所。雷雲から水平距離50〜150km離れて側方〜背後を狙う。\n"
+    "- 季節/時間: 暖候期(5〜9月)。時刻は21〜02時が最有利、18〜20時/3〜5時が次点。\n"
+    "- 気象: 雷活動が非常に活発(落雷多いセル/強エコー)。雲量20%以下。視程20km以上。降水域の真下は避ける。\n"
+    "- 光条件: 新月〜三日月や月が低い/陰るタイミング。街灯や車灯が少ない暗所で暗順応。\n"
+    "- 観測姿勢: 雷雲の真上ではなく少し離れた上空を注視。広角・長秒露光+三脚、連写/インターバル撮影で記録。"
+)
+
+_FORMULA_MD = "\n".join(
+    [
+        "- 台形スコアで0〜1に正規化後、重み付き和で z を計算しロジスティック変換",
+        "  緯度: low=-10, 最適=10〜45, high=60 → 重み0.6",
+        "  季節: low=2.5, 最適=5〜9, high=11.5 → 重み0.5",
+        "  時刻: 21-02時=1.0, 18-20/3-5時=0.6, それ以外=0.1 → 重み0.4",
+        "  雷活動: (0〜10)/10 → 重み2.0",
+        "  雲量: (1 - 雲量%/100) → 重み0.4",
+        "  月明かり: (1 - 明るさ%/100) → 重み0.2",
+        "  視程: (km/40) → 重み0.6",
+        "- z = -3.0 + Σ(重み×スコア), 確率 = 1/(1+exp(-z)) を0〜100%表示",
+        "- 70%以上: 良好, 40%以上: 並, それ未満: 弱め のヒント",
+    ]
+)
 
 
 def show_best_conditions() -> None:
-    st.info(
-        "理想に近い観測条件の目安:\n"
-        "- 場所: 緯度10〜45度帯。都市光害が少ない開けた場所。雷雲から水平距離50〜150km離れて側方〜背後を狙う。\n"
-        "- 季節/時間: 暖候期(5〜9月)。時刻は21〜02時が最有利、18〜20時/3〜5時が次点。\n"
-        "- 気象: 雷活動が非常に活発(落雷多いセル/強エコー)。雲量20%以下。視程20km以上。降水域の真下は避ける。\n"
-        "- 光条件: 新月〜三日月や月が低い/陰るタイミング。街灯や車灯が少ない暗所で暗順応。\n"
-        "- 観測姿勢: 雷雲の真上ではなく少し離れた上空を注視。広角・長秒露光+三脚、連写/インターバル撮影で記録。"
-    )
+    st.info(_BEST_CONDITIONS_MD)
 
 
 def show_formula() -> None:
     with st.expander("計算方式を見る", expanded=False):
-        st.markdown(
-            "\n".join(
-                [
-                    "- 台形スコアで0〜1に正規化後、重み付き和で z を計算しロジスティック変換",
-                    "  緯度: low=-10, 最適=10〜45, high=60 → 重み0.6",
-                    "  季節: low=2.5, 最適=5〜9, high=11.5 → 重み0.5",
-                    "  時刻: 21-02時=1.0, 18-20/3-5時=0.6, それ以外=0.1 → 重み0.4",
-                    "  雷活動: (0〜10)/10 → 重み2.0",
-                    "  雲量: (1 - 雲量%/100) → 重み0.4",
-                    "  月明かり: (1 - 明るさ%/100) → 重み0.2",
-                    "  視程: (km/40) → 重み0.6",
-                    "- z = -3.0 + Σ(重み×スコア), 確率 = 1/(1+exp(-z)) を0〜100%表示",
-                    "- 70%以上: 良好, 40%以上: 並, それ未満: 弱め のヒント",
-                ]
-            )
-        )
+        st.markdown(_FORMULA_MD)
 
 
 def main() -> None:
     init_state()
     st.title("レッドスプライト観測予測 (Web版)")
 
-    # アクションを先に処理することで、状態更新後に入力ウィジェットが再描画される
+    # アクションを先に処理することで、状態更新後に入力ウィジェットが再描画される。
+    # 「自動取得」送信もここ（ウィジェット生成前）で処理する: フォーム送信で
+    # lat/lon/hourは同期済みで、cloud/moon/visへの書き込みが同一実行内で反映される
+    if st.session_state.pop("fetch_requested", False):
+        auto_fetch()
     render_actions()
 
     col_map, col_form = st.columns([1, 1])
     with col_map:
         render_map()
     with col_form:
-        render_inputs()
+        submitted = render_inputs()
+
+    if submitted:
+        run_prediction_and_show()
+    render_result()
 
     show_formula()
 